@@ -4,87 +4,215 @@
 # Python-based spaced repetition system with vim interface
 
 import argparse
+import atexit
+import contextlib
+import functools
 import hashlib
 import os
+import re
 import sqlite3
 import subprocess
-from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from pathlib import Path
 
 
 # Spaced repetition intervals - days until next review after correct answer
 SCHEDULE_INTERVALS_DAYS = [0, 1, 3, 7, 14, 28, 56]
+_MAX_IDX = len(SCHEDULE_INTERVALS_DAYS) - 1
+_TIMEDELTAS = tuple(timedelta(days=d) for d in SCHEDULE_INTERVALS_DAYS)
 DB_PATH = Path.home() / "anki" / "anki.db"
 
+# SQLite's default bound-parameter limit - IN (...) queries are issued in slices of this size
+SQLITE_MAX_VARIABLES = 999
+
+# Thread pool size for parsing files in the tree view (I/O bound, so more threads than cores)
+PARSE_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Shared connection, opened once by initialize_database() and reused for the whole session
+_CONN = None
+
+# All non-DDL statements live here. sqlite3's statement cache keys on the SQL text, so one
+# shared string per statement means every call site reuses the same prepared statement.
+# Schema setup and the one-shot migration stay inline in initialize_database() - they run once.
+# schedule_info lookups and deletes are PRIMARY KEY searches
+_STMT_SELECT = "SELECT due_date, review_date_index FROM schedule_info WHERE question_hash = ?"
+_STMT_SELECT_MANY = "SELECT question_hash, due_date, review_date_index FROM schedule_info WHERE question_hash IN ({})"
+_STMT_UPSERT = "INSERT OR REPLACE INTO schedule_info (question_hash, due_date, review_date_index) VALUES (?, ?, ?)"
+_STMT_DELETE = "DELETE FROM schedule_info WHERE question_hash = ?"
+_STMT_DELETE_MANY = "DELETE FROM schedule_info WHERE question_hash IN ({})"
+_STMT_SELECT_FILE_STATE = "SELECT path, mtime_ns, due_count, min_due_ordinal FROM file_state"
+_STMT_UPSERT_FILE_STATE = "INSERT OR REPLACE INTO file_state (path, mtime_ns, due_count, min_due_ordinal) VALUES (?, ?, ?, ?)"
+_STMT_PRUNE_FILE_STATE = "DELETE FROM file_state WHERE substr(path, 1, ?) = ? AND path NOT IN (SELECT path FROM known_files)"
+_STMT_SELECT_KNOWN_FILES = "SELECT path, mtime_ns FROM known_files"
+_STMT_INSERT_KNOWN_FILE = "INSERT INTO known_files (path, mtime_ns) VALUES (?, ?)"
+_STMT_REGISTER_KNOWN_FILE = "INSERT OR IGNORE INTO known_files (path, mtime_ns) VALUES (?, 0)"
+_STMT_DELETE_KNOWN_FILES_UNDER = "DELETE FROM known_files WHERE substr(path, 1, ?) = ?"
+_STMT_CREATE_CURRENT_HASHES = "CREATE TEMP TABLE IF NOT EXISTS current_hashes (h TEXT PRIMARY KEY)"
+_STMT_CLEAR_CURRENT_HASHES = "DELETE FROM current_hashes"
+_STMT_INSERT_CURRENT_HASH = "INSERT INTO current_hashes (h) VALUES (?)"
+_STMT_DELETE_ORPHANS = "DELETE FROM schedule_info WHERE question_hash NOT IN (SELECT h FROM current_hashes)"
+
+
+# Start of every question line - chunk boundaries are found on the raw bytes
+QUESTION_LINE_PATTERN = re.compile(rb'^\?', re.MULTILINE)
+
 
 # Vim exit codes determine review outcome
 QUIT, WRONG, EDIT, SKIP, CORRECT, UNDO = 0, 1, 2, 3, 4, 5
 
 
-def compute_sha256_hash(text):
-    return hashlib.sha256(text.encode()).hexdigest()
+def compute_sha256_hashes(texts):
+    """SHA-256 hex digest of each text - encodes everything up front and hashes in one tight loop."""
+    sha256 = hashlib.sha256
+    return [sha256(data).hexdigest() for data in [text.encode() for text in texts]]
 
 
 def parse_question_answer_pair_chunks_from_file(file_path):
-    """Parse file into chunks, where each chunk starts with a '?' line."""
-    with open(file_path, 'r') as file_handle:
-        content = file_handle.read()
-
-    question_answer_pair_chunks = []
-    current_chunk_lines = []
-
-    for line in content.split('\n'):
-        if line.startswith('?'):
-            # New question found - save previous chunk if exists
-            if current_chunk_lines:
-                while current_chunk_lines and current_chunk_lines[-1] == '':
-                    current_chunk_lines.pop()
-                if current_chunk_lines:
-                    question_answer_pair_chunks.append('\n'.join(current_chunk_lines))
-            current_chunk_lines = [line]
-        elif current_chunk_lines:
-            # Continue accumulating lines for current question
-            current_chunk_lines.append(line)
-
-    # Handle final chunk
-    if current_chunk_lines:
-        while current_chunk_lines and current_chunk_lines[-1] == '':
-            current_chunk_lines.pop()
-        if current_chunk_lines:
-            question_answer_pair_chunks.append('\n'.join(current_chunk_lines))
-
-    return question_answer_pair_chunks
+    """Parse file into chunks, where each chunk starts with a '?' line.
+    Returns [(question_line, chunk, question_hash, line_number)], cached until the file changes."""
+    return list(_parse_file_cached(*_file_cache_key(file_path)))
+
+
+def _file_cache_key(file_path):
+    stat = os.stat(file_path)
+    return str(file_path), stat.st_mtime_ns, stat.st_size
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_file_cached(file_path, mtime_ns, size):
+    """Keyed on (path, mtime, size) so an edited file is re-read."""
+    with open(file_path, 'rb') as file_handle:
+        data = file_handle.read()
+    # Same newline handling as text mode
+    if b'\r' in data:
+        data = data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+
+    # Slice between question-line offsets instead of looping over lines in Python
+    offsets = [match.start() for match in QUESTION_LINE_PATTERN.finditer(data)]
+    offsets.append(len(data))
+
+    chunks, question_lines, line_numbers = [], [], []
+    line_number, previous_start = 1, 0
+    for start, end in zip(offsets, offsets[1:]):
+        line_number += data.count(b'\n', previous_start, start)
+        previous_start = start
+        # Trailing blank lines are just trailing newlines; the question line keeps the chunk non-empty
+        chunk = data[start:end].rstrip(b'\n').decode()
+        chunks.append(chunk)
+        question_lines.append(chunk.partition('\n')[0])
+        line_numbers.append(line_number)
+
+    # Hash each question line exactly once, here, in one batch
+    question_hashes = compute_sha256_hashes(question_lines)
+    return tuple(zip(question_lines, chunks, question_hashes, line_numbers))
+
+
+@contextlib.contextmanager
+def database_transaction(connection):
+    """BEGIN ... COMMIT on the autocommit connection. Rolls back if the block raises, so the
+    shared connection is never left inside an open transaction."""
+    connection.execute("BEGIN")
+    try:
+        yield connection
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
 
 
 def initialize_database():
+    """Open the shared connection (once) and create the schema. Returns the connection."""
+    global _CONN
+    if _CONN is not None:
+        return _CONN
+
     DB_PATH.parent.mkdir(parents=True, exist_ok=True)
-    connection = sqlite3.connect(DB_PATH)
+    # Autocommit mode - multi-statement updates go through database_transaction()
+    connection = sqlite3.connect(DB_PATH, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute("PRAGMA temp_store=MEMORY")
+    connection.execute("PRAGMA cache_size=-64000")
+    # due_date is stored as date.toordinal() so due checks are plain integer comparisons
     connection.execute("""
         CREATE TABLE IF NOT EXISTS schedule_info (
             question_hash TEXT PRIMARY KEY,
-            due_date TEXT NOT NULL,
+            due_date INTEGER NOT NULL,
             review_date_index INTEGER NOT NULL
         );
     """)
-    connection.commit()
-    connection.close()
-
+    migrate_due_date_to_ordinal(connection)
+    # Per-file manifest so the tree view can skip files with nothing due (see count_due_questions_in_file)
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS file_state (
+            path TEXT PRIMARY KEY,
+            mtime_ns INTEGER NOT NULL,
+            due_count INTEGER NOT NULL,
+            min_due_ordinal INTEGER
+        );
+    """)
+    # Every file the last orphan cleanup saw, so the next one can tell whether anything changed.
+    # Kept apart from file_state because the triggers below delete file_state rows
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS known_files (
+            path TEXT PRIMARY KEY,
+            mtime_ns INTEGER NOT NULL
+        );
+    """)
+    # A manifest only goes stale if some card becomes due before the file's recorded minimum:
+    # a write with an earlier due date, or a deleted row (card becomes new, i.e. due today)
+    connection.execute("""
+        CREATE TRIGGER IF NOT EXISTS file_state_invalidate_on_insert AFTER INSERT ON schedule_info
+        BEGIN
+            DELETE FROM file_state WHERE min_due_ordinal > NEW.due_date;
+        END;
+    """)
+    connection.execute("""
+        CREATE TRIGGER IF NOT EXISTS file_state_invalidate_on_delete AFTER DELETE ON schedule_info
+        BEGIN
+            DELETE FROM file_state WHERE min_due_ordinal IS NOT NULL;
+        END;
+    """)
+    atexit.register(connection.close)
+    _CONN = connection
+    return _CONN
 
-def get_due_date_and_schedule_index_from_database(question_hash):
-    connection = sqlite3.connect(DB_PATH)
-    cursor = connection.execute(
-        "SELECT due_date, review_date_index FROM schedule_info WHERE question_hash = ?",
-        [question_hash]
-    )
-    result = cursor.fetchone()
-    connection.close()
-    return result
 
+def migrate_due_date_to_ordinal(connection):
+    """One-shot migration of older databases that stored due_date as 'YYYY-MM-DD' TEXT."""
+    columns = {row[1]: row[2] for row in connection.execute("PRAGMA table_info(schedule_info)")}
+    if columns.get('due_date', '').upper() != 'TEXT':
+        return
 
-def update_schedule_after_review(question_hash, review_result):
-    """Single entry point for all review outcomes"""
-    info = get_due_date_and_schedule_index_from_database(question_hash)
+    # julianday('0001-01-01') - 1 == 1721424.5, so this yields Python's date.toordinal()
+    with database_transaction(connection):
+        connection.execute("""
+            CREATE TABLE schedule_info_new (
+                question_hash TEXT PRIMARY KEY,
+                due_date INTEGER NOT NULL,
+                review_date_index INTEGER NOT NULL
+            );
+        """)
+        connection.execute("""
+            INSERT INTO schedule_info_new (question_hash, due_date, review_date_index)
+            SELECT question_hash, CAST(julianday(due_date) - 1721424.5 AS INTEGER), review_date_index
+            FROM schedule_info
+        """)
+        connection.execute("DROP TABLE schedule_info")
+        connection.execute("ALTER TABLE schedule_info_new RENAME TO schedule_info")
+
+
+def get_due_date_and_schedule_index_from_database(question_hash, conn=None):
+    conn = conn or initialize_database()
+    cursor = conn.execute(_STMT_SELECT, [question_hash])
+    return cursor.fetchone()
+
+
+def update_schedule_after_review(question_hash, review_result, conn=None):
+    """Single entry point for all review outcomes. Returns the previous (due_date, review_date_index), or None if new."""
+    conn = conn or initialize_database()
+    info = get_due_date_and_schedule_index_from_database(question_hash, conn)
     # New cards start at index 1 (skip 0-day and 1-day intervals)
     # First correct answer will advance to index 2 (3-day interval)
     current_index = info[1] if info else 1
@@ -94,43 +222,90 @@ def update_schedule_after_review(question_hash, review_result):
         new_index = 0
         due_date = today
     elif review_result == CORRECT:
-        new_index = min(current_index + 1, len(SCHEDULE_INTERVALS_DAYS) - 1)
-        due_date = today + timedelta(days=SCHEDULE_INTERVALS_DAYS[new_index])
+        new_index = current_index + 1 if current_index < _MAX_IDX else _MAX_IDX
+        due_date = today + _TIMEDELTAS[new_index]
     elif review_result == SKIP:
         new_index = current_index
         due_date = today
 
-    connection = sqlite3.connect(DB_PATH)
-    connection.execute(
-        "INSERT OR REPLACE INTO schedule_info (question_hash, due_date, review_date_index) VALUES (?, ?, ?)",
-        [question_hash, due_date.strftime("%Y-%m-%d"), new_index]
-    )
-    connection.commit()
-    connection.close()
+    conn.execute(_STMT_UPSERT, [question_hash, due_date.toordinal(), new_index])
+    return info
+
+
+def review_and_record(question_hash, review_result, conn=None):
+    """Read the previous state and write the new one in a single transaction. Returns the previous state for undo."""
+    conn = conn or initialize_database()
+    with database_transaction(conn):
+        return update_schedule_after_review(question_hash, review_result, conn)
+
+
+def fetch_due_map(question_hashes, conn=None):
+    """Look up schedule info for many hashes at once: {hash: (due_date, review_date_index)}. Missing hashes are new."""
+    conn = conn or initialize_database()
+    question_hashes = list(question_hashes)
+    due_map = {}
+    for start in range(0, len(question_hashes), SQLITE_MAX_VARIABLES):
+        batch = question_hashes[start:start + SQLITE_MAX_VARIABLES]
+        cursor = conn.execute(_STMT_SELECT_MANY.format(','.join('?' * len(batch))), batch)
+        for question_hash, due_date, review_date_index in cursor:
+            due_map[question_hash] = (due_date, review_date_index)
+    return due_map
 
 
-def is_question_due_for_review(question_hash):
-    """New questions (not in DB) are always due."""
-    info = get_due_date_and_schedule_index_from_database(question_hash)
-    if info is None:
-        return True
-    due_date = datetime.strptime(info[0], "%Y-%m-%d").date()
-    return due_date <= datetime.now().date()
+def parse_files_in_parallel(file_paths):
+    """Parse many files on a thread pool: {file_path: parsed chunks}. Only parsing happens off the main thread."""
+    file_paths = list(file_paths)
+    if len(file_paths) < 2:
+        return {p: parse_question_answer_pair_chunks_from_file(p) for p in file_paths}
+    with ThreadPoolExecutor(max_workers=PARSE_WORKERS) as executor:
+        return dict(zip(file_paths, executor.map(parse_question_answer_pair_chunks_from_file, file_paths)))
 
 
 def count_due_questions_in_file(file_path):
     """Count how many questions in the file are due for review today."""
     if not os.path.isfile(file_path):
         return 0
+    return count_due_questions_in_files([file_path])[file_path]
+
+
+def count_due_questions_in_files(file_paths):
+    """Count due questions for many files at once: {file_path: count}. Files whose manifest shows
+    nothing due are not opened; the rest are parsed in parallel and looked up in one batched query."""
+    conn = initialize_database()
+    today = datetime.now().date().toordinal()
+    manifest = {path: (mtime_ns, due_count, min_due_ordinal) for path, mtime_ns, due_count, min_due_ordinal
+                in conn.execute(_STMT_SELECT_FILE_STATE)}
+
+    counts = {}
+    stale = []
+    for file_path in file_paths:
+        mtime_ns = os.stat(file_path).st_mtime_ns
+        row = manifest.get(os.path.abspath(file_path))
+        # Unchanged file whose earliest card is still in the future - no need to open it
+        if row and row[0] == mtime_ns and (row[2] is None or row[2] > today):
+            counts[file_path] = row[1]
+        else:
+            stale.append((file_path, mtime_ns))
+
+    parsed = parse_files_in_parallel(file_path for file_path, _ in stale)
+    due_map = fetch_due_map({h for chunks in parsed.values() for _, _, h, _ in chunks}, conn)
+
+    with database_transaction(conn):
+        for file_path, mtime_ns in stale:
+            # New questions (not in DB) are due today
+            due_ordinals = [due_map[h][0] if h in due_map else today for _, _, h, _ in parsed[file_path]]
+            counts[file_path] = sum(1 for due_ordinal in due_ordinals if due_ordinal <= today)
+            conn.execute(_STMT_UPSERT_FILE_STATE,
+                         [os.path.abspath(file_path), mtime_ns, counts[file_path], min(due_ordinals, default=None)])
+    return counts
 
-    chunks = parse_question_answer_pair_chunks_from_file(file_path)
-    count = 0
-    for chunk in chunks:
-        question_line = chunk.split('\n')[0]
-        question_hash = compute_sha256_hash(question_line)
-        if is_question_due_for_review(question_hash):
-            count += 1
-    return count
+
+def files_unchanged_since_cleanup(conn, anki_path, file_mtimes):
+    """True if the files under anki_path are exactly the ones the last orphan cleanup recorded, all unmodified."""
+    prefix = os.path.join(os.path.abspath(anki_path), '')
+    known = {path: mtime_ns for path, mtime_ns in conn.execute(_STMT_SELECT_KNOWN_FILES)
+             if path.startswith(prefix)}
+    return known == file_mtimes
 
 
 def delete_orphaned_schedule_entries(anki_path):
@@ -142,22 +317,29 @@ def delete_orphaned_schedule_entries(anki_path):
     if not anki_path.exists():
         return
 
+    conn = initialize_database()
+    file_paths = list(anki_path.rglob('*.txt'))
+    file_mtimes = {os.path.abspath(p): os.stat(p).st_mtime_ns for p in file_paths}
+    # Questions can only have disappeared if a file was edited, added or removed since the last cleanup
+    if files_unchanged_since_cleanup(conn, anki_path, file_mtimes):
+        return
+
     # Collect all current question hashes from files
     current = set()
-    for file_handle in anki_path.rglob('*.txt'):
-        for question_answer_pair_chunk in parse_question_answer_pair_chunks_from_file(file_handle):
-            current.add(compute_sha256_hash(question_answer_pair_chunk.split('\n')[0]))
-
-    # Find and delete orphaned entries
-    connection = sqlite3.connect(DB_PATH)
-    cursor = connection.execute("SELECT question_hash FROM schedule_info")
-    db_hashes = set(row[0] for row in cursor.fetchall())
-
-    for orphan_hash in db_hashes - current:
-        connection.execute("DELETE FROM schedule_info WHERE question_hash = ?", (orphan_hash,))
-
-    connection.commit()
-    connection.close()
+    for chunks in parse_files_in_parallel(file_paths).values():
+        current.update(h for _, _, h, _ in chunks)
+
+    prefix = os.path.join(os.path.abspath(anki_path), '')
+    with database_transaction(conn):
+        # Delete orphaned entries in one statement against a temp table of current hashes
+        conn.execute(_STMT_CREATE_CURRENT_HASHES)
+        conn.execute(_STMT_CLEAR_CURRENT_HASHES)
+        conn.executemany(_STMT_INSERT_CURRENT_HASH, ((h,) for h in current))
+        conn.execute(_STMT_DELETE_ORPHANS)
+        # Remember what this cleanup saw, and drop manifests of files that are gone
+        conn.execute(_STMT_DELETE_KNOWN_FILES_UNDER, [len(prefix), prefix])
+        conn.executemany(_STMT_INSERT_KNOWN_FILE, file_mtimes.items())
+        conn.execute(_STMT_PRUNE_FILE_STATE, [len(prefix), prefix])
 
 
 def display_due_questions_tree(path=None):
@@ -174,6 +356,9 @@ def display_due_questions_tree(path=None):
         print(f"{path.name} {count_due_questions_in_file(path)}")
         return
 
+    # Walk first, then count every file in one batch, then print
+    rows = []  # [(line prefix, entry, is_dir)]
+
     def walk_directory(directory, prefix=""):
         entries = [e for e in directory.iterdir()
                    if not e.name.startswith('.') and (e.is_dir() or e.suffix == '.txt')]
@@ -183,15 +368,20 @@ def display_due_questions_tree(path=None):
             connector = "└── " if is_last else "├── "
             extension = "    " if is_last else "│   "
 
-            if entry.is_dir():
-                print(f"{prefix}{connector}{entry.name}/")
+            is_dir = entry.is_dir()
+            rows.append((f"{prefix}{connector}", entry, is_dir))
+            if is_dir:
                 walk_directory(entry, prefix + extension)
-            else:
-                count = count_due_questions_in_file(entry)
-                print(f"{prefix}{connector}{entry.name} {count}")
 
-    print(".")
     walk_directory(path)
+    counts = count_due_questions_in_files([entry for _, entry, is_dir in rows if not is_dir])
+
+    print(".")
+    for line_prefix, entry, is_dir in rows:
+        if is_dir:
+            print(f"{line_prefix}{entry.name}/")
+        else:
+            print(f"{line_prefix}{entry.name} {counts[entry]}")
 
 
 def display_flashcard_in_vim(question_answer_pair_chunk, name=None):
@@ -206,21 +396,10 @@ def display_flashcard_in_vim(question_answer_pair_chunk, name=None):
     return result.returncode
 
 
-def open_file_for_editing(file_path, question_line=None):
-    """Open the source file in vim for editing, optionally at the question's line."""
-    if question_line:
-        # Use grep to find the line number
-        result = subprocess.run(
-            ['grep', '-n', '-F', '-m', '1', question_line, file_path],
-            capture_output=True,
-            text=True
-        )
-        if result.stdout:
-            line_number = result.stdout.split(':')[0]
-            subprocess.run(['vim', f'+{line_number}', '-c', 'normal zt', file_path])
-        else:
-            # Fallback if grep fails
-            subprocess.run(['vim', file_path])
+def open_file_for_editing(file_path, line_number=None):
+    """Open the source file in vim for editing, optionally at the question's line (recorded by the parser)."""
+    if line_number:
+        subprocess.run(['vim', f'+{line_number}', '-c', 'normal zt', file_path])
     else:
         subprocess.run(['vim', file_path])
     subprocess.run(['clear'])
@@ -228,11 +407,14 @@ def open_file_for_editing(file_path, question_line=None):
 
 def get_due_questions(question_answer_pair_chunks):
     """Filter chunks to only those due for review today."""
+    due_map = fetch_due_map(h for _, _, h, _ in question_answer_pair_chunks)
+    today = datetime.now().date().toordinal()
+
     due = []
-    for chunk in question_answer_pair_chunks:
-        question_line = chunk.split('\n')[0]
-        if is_question_due_for_review(compute_sha256_hash(question_line)):
-            due.append((question_line, chunk))
+    for question_line, chunk, question_hash, line_number in question_answer_pair_chunks:
+        info = due_map.get(question_hash)
+        if info is None or info[0] <= today:
+            due.append((question_line, chunk, question_hash, line_number))
     return due
 
 
@@ -242,75 +424,85 @@ def review_due_questions(file_path):
         print(f"File not found: {file_path}")
         return
 
-    initialize_database()
+    conn = initialize_database()
+    # Make sure the next orphan cleanup looks at this file, even if it is deleted before the tree is shown
+    conn.execute(_STMT_REGISTER_KNOWN_FILE, [os.path.abspath(file_path)])
     reviewed_hashes = set()  # Track questions already answered this session
-    history_stack = []  # Track previous states for undo: [(hash, prev_state, question_data)]
+    due = []  # Cards for this pass, never mutated - reviewed cards are kept at the front for undo
+    history = []  # Indices into due of reviewed cards, most recent last
+    prev_state_by_idx = {}  # Schedule state before each review, restored on undo
 
     while True:
         # Re-parse file (fresh content after edits)
         question_answer_pair_chunks = parse_question_answer_pair_chunks_from_file(file_path)
-        due = get_due_questions(question_answer_pair_chunks)
 
         # Filter out questions we've already reviewed this session
-        due = [(q, c) for q, c in due
-               if compute_sha256_hash(q) not in reviewed_hashes]
+        fresh = [card for card in get_due_questions(question_answer_pair_chunks)
+                 if card[2] not in reviewed_hashes]
 
-        if not due:
+        if not fresh:
             if not reviewed_hashes:
                 print("No due questions in this file.")
             subprocess.run(['clear'])
             return
 
-        # Use deque for flexible card navigation
-        due_deque = deque(due)
-
-        while due_deque:
-            question_line, question_answer_pair_chunk = due_deque.popleft()
-            question_hash = compute_sha256_hash(question_line)
+        # Carry reviewed cards over in front of the new ones so undo can still step back to them.
+        # Their line numbers are re-read from this parse (first occurrence wins, like the old grep);
+        # a question that was deleted from the file opens the editor at the top
+        line_numbers = {}
+        for _, _, h, n in question_answer_pair_chunks:
+            line_numbers.setdefault(h, n)
+        prev_state_by_idx = {i: prev_state_by_idx[idx] for i, idx in enumerate(history)}
+        due = [(q, c, h, line_numbers.get(h)) for q, c, h, _ in (due[idx] for idx in history)] + fresh
+        history = list(range(len(history)))
+        cursor_idx = len(history)
+
+        while cursor_idx < len(due):
+            _, question_answer_pair_chunk, question_hash, line_number = due[cursor_idx]
             exit_code = display_flashcard_in_vim(question_answer_pair_chunk, file_path)
 
             if exit_code == QUIT:
                 subprocess.run(['clear'])
                 return
             elif exit_code == EDIT:
-                open_file_for_editing(file_path, question_line)
+                file_key = _file_cache_key(file_path)
+                open_file_for_editing(file_path, line_number)
+                if _file_cache_key(file_path) == file_key:
+                    continue  # Quit without writing - nothing changed, show this card again
                 break  # Exit inner loop to re-parse file
             elif exit_code == UNDO:
-                if not history_stack:
+                if not history:
                     subprocess.run(['clear'])
                     return  # No history - terminate session
 
                 # Pop the last reviewed question
-                prev_hash, prev_state, (prev_q_line, prev_chunk) = history_stack.pop()
+                prev_idx = history.pop()
+                prev_hash = due[prev_idx][2]
+                prev_state = prev_state_by_idx.pop(prev_idx)
 
                 # Restore previous database state
-                connection = sqlite3.connect(DB_PATH)
-                if prev_state is None:
-                    # Was a new question - remove from database
-                    connection.execute("DELETE FROM schedule_info WHERE question_hash = ?", [prev_hash])
-                else:
-                    # Restore the old state
-                    connection.execute(
-                        "INSERT OR REPLACE INTO schedule_info (question_hash, due_date, review_date_index) VALUES (?, ?, ?)",
-                        [prev_hash, prev_state[0], prev_state[1]]
-                    )
-                connection.commit()
-                connection.close()
+                with database_transaction(conn):
+                    if prev_state is None:
+                        # Was a new question - remove from database
+                        conn.execute(_STMT_DELETE, [prev_hash])
+                    else:
+                        # Restore the old state
+                        conn.execute(_STMT_UPSERT, [prev_hash, prev_state[0], prev_state[1]])
 
                 # Remove from reviewed set so it can be shown again
                 reviewed_hashes.discard(prev_hash)
 
-                # Put current card back on the queue, then the previous card
-                due_deque.appendleft((question_line, question_answer_pair_chunk))
-                due_deque.appendleft((prev_q_line, prev_chunk))
+                # Step back to the previous card - the current card follows it again
+                cursor_idx = prev_idx
             else:
                 # Normal review outcomes (WRONG, CORRECT, SKIP)
-                # Capture previous state before updating
-                prev_state = get_due_date_and_schedule_index_from_database(question_hash)
-                history_stack.append((question_hash, prev_state, (question_line, question_answer_pair_chunk)))
+                # Capture previous state and update in one transaction
+                prev_state = review_and_record(question_hash, exit_code, conn)
+                history.append(cursor_idx)
+                prev_state_by_idx[cursor_idx] = prev_state
 
-                update_schedule_after_review(question_hash, exit_code)
                 reviewed_hashes.add(question_hash)
+                cursor_idx += 1
         else:
             # while-loop completed without break = all done
             subprocess.run(['clear'])
@@ -329,7 +521,7 @@ def custom_study_all_questions(file_path):
         return
 
     print(f"Custom study mode: {len(question_answer_pair_chunks)} questions\n")
-    for question_answer_pair_chunk in question_answer_pair_chunks:
+    for _, question_answer_pair_chunk, _, _ in question_answer_pair_chunks:
         display_flashcard_in_vim(question_answer_pair_chunk, file_path)
 
 
@@ -343,24 +535,18 @@ def forget_file_schedule(file_path):
         print("No database exists.")
         return
 
-    chunks = parse_question_answer_pair_chunks_from_file(file_path)
-    if not chunks:
+    question_hashes = [h for _, _, h, _ in parse_question_answer_pair_chunks_from_file(file_path)]
+    if not question_hashes:
         print("No questions found in this file.")
         return
 
-    connection = sqlite3.connect(DB_PATH)
+    conn = initialize_database()
     deleted = 0
-    for chunk in chunks:
-        question_line = chunk.split('\n')[0]
-        question_hash = compute_sha256_hash(question_line)
-        cursor = connection.execute(
-            "DELETE FROM schedule_info WHERE question_hash = ?",
-            [question_hash]
-        )
-        deleted += cursor.rowcount
-
-    connection.commit()
-    connection.close()
+    with database_transaction(conn):
+        for start in range(0, len(question_hashes), SQLITE_MAX_VARIABLES):
+            batch = question_hashes[start:start + SQLITE_MAX_VARIABLES]
+            cursor = conn.execute(_STMT_DELETE_MANY.format(','.join('?' * len(batch))), batch)
+            deleted += cursor.rowcount
     print(f"Forgot {deleted} question(s) from schedule.")
 
 